@@ -1,32 +1,88 @@
 import streamlit as st
 from datetime import date
-from pydantic import BaseModel, Field, validator
-from ulid import ULID
-import bcrypt, os, json, pandas as pd
-from util.excel_template import export_excel
-from typing import Optional
+from pydantic import BaseModel, TypeAdapter
+import os, hashlib, shutil, tempfile, threading, orjson
+from typing import Literal, Optional, get_args
+from collections import OrderedDict
+from pathlib import Path
 import uuid
 
 # ---- Supabase client (optional) ----
 SUPABASE_URL = st.secrets.get("SUPABASE_URL", None)
 SUPABASE_ANON_KEY = st.secrets.get("SUPABASE_ANON_KEY", None)
 SUPABASE_SERVICE_ROLE_KEY = st.secrets.get("SUPABASE_SERVICE_ROLE_KEY", None)
-APP_ADMIN_EMAILS = [e.strip().lower() for e in st.secrets.get("APP_ADMIN_EMAILS","").split(",") if e.strip()]
-
-if SUPABASE_URL and SUPABASE_ANON_KEY:
-    from supabase import create_client, Client
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-    supabase_admin: Optional[Client] = None
-    if SUPABASE_SERVICE_ROLE_KEY:
-        supabase_admin = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-else:
-    supabase = None
-    supabase_admin = None
-    os.makedirs("data", exist_ok=True)
+APP_ADMIN_EMAILS = frozenset(e.strip().lower() for e in st.secrets.get("APP_ADMIN_EMAILS","").split(",") if e.strip())
+# Remember bcrypt verification results in process memory (set false to always re-check)
+PWD_CACHE_ENABLED = str(st.secrets.get("PWD_CACHE_ENABLED", "true")).lower() not in ("0", "false", "no")
+PWD_CACHE_SIZE = 512
+# bcrypt work factor for new hashes; "argon2" scheme needs passlib + argon2-cffi
+BCRYPT_COST = int(st.secrets.get("BCRYPT_COST", 10))
+PASSWORD_SCHEME = st.secrets.get("PASSWORD_SCHEME", "bcrypt")
+
+USE_SUPABASE = bool(SUPABASE_URL and SUPABASE_ANON_KEY)
+
+# Clients are built once per process (the script body re-executes on every rerun);
+# the service-role client is only created when an admin path first asks for it
+@st.cache_resource(show_spinner=False)
+def get_supabase():
+    if not USE_SUPABASE:
+        return None
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+
+@st.cache_resource(show_spinner=False)
+def get_supabase_admin():
+    if not (USE_SUPABASE and SUPABASE_SERVICE_ROLE_KEY):
+        return None
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
 # ---- Helpers ----
-def hash_pwd(p): return bcrypt.hashpw(p.encode(), bcrypt.gensalt()).decode()
-def check_pwd(p, h): return bcrypt.checkpw(p.encode(), h.encode())
+@st.cache_resource(show_spinner=False)
+def _pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["argon2","bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_COST)
+
+def hash_pwd(p):
+    if PASSWORD_SCHEME == "argon2":
+        return _pwd_context().hash(p)
+    import bcrypt
+    return bcrypt.hashpw(p.encode(), bcrypt.gensalt(BCRYPT_COST)).decode()
+
+def _verify_pwd(p, h):
+    # Existing $2b$ records keep using bcrypt directly; only argon2 hashes need passlib
+    if h.startswith("$argon2"):
+        return _pwd_context().verify(p, h)
+    import bcrypt
+    return bcrypt.checkpw(p.encode(), h.encode())
+
+# Bounded LRU of sha256(password|hash) -> result; the raw password is never stored.
+# Held in cache_resource because the script body re-executes on every rerun; that also
+# shares it across session threads, so dict access goes through the lock (bcrypt runs outside it).
+@st.cache_resource(show_spinner=False)
+def _pwd_cache() -> "tuple[OrderedDict[bytes, bool], threading.Lock]":
+    return OrderedDict(), threading.Lock()
+
+def check_pwd(p, h):
+    if not PWD_CACHE_ENABLED:
+        return _verify_pwd(p, h)
+    cache, lock = _pwd_cache()
+    key = hashlib.sha256((p + "|" + h).encode()).digest()
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    ok = _verify_pwd(p, h)
+    with lock:
+        cache[key] = ok
+        if len(cache) > PWD_CACHE_SIZE:
+            cache.popitem(last=False)
+    return ok
+
+def _clear_pwd_cache():
+    cache, lock = _pwd_cache()
+    with lock:
+        cache.clear()
 
 def is_admin(email: str):
     if email and email.lower() in APP_ADMIN_EMAILS:
@@ -37,28 +93,83 @@ def get_role_from_query():
     role = st.query_params.get("role", ["user"])[0]
     return role
 
+# Runs once per process rather than on every rerun
+@st.cache_resource(show_spinner=False)
 def ensure_tables_exist():
     # For demo/local mode only
-    if not supabase:
+    if not USE_SUPABASE:
+        data_dir = Path("data")
+        data_dir.mkdir(exist_ok=True)
         for fname in ["users.jsonl","applicants.jsonl"]:
-            path = os.path.join("data", fname)
-            if not os.path.exists(path):
-                open(path,"w").close()
+            (data_dir / fname).touch(exist_ok=True)
 
 def save_jsonl(path, obj):
-    with open(path,"a") as f:
-        f.write(json.dumps(obj, default=str)+"\n")
+    with open(path,"ab") as f:
+        f.write(orjson.dumps(obj, default=str, option=orjson.OPT_APPEND_NEWLINE))
+
+def write_jsonl(path, rows):
+    # Write to a unique temp file, fsync it, swap it in, then fsync the directory so the
+    # rename itself survives power loss; concurrent writers don't share a temp file
+    blob = b"".join(orjson.dumps(r, default=str, option=orjson.OPT_APPEND_NEWLINE) for r in rows)
+    dirname = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile("wb", dir=dirname, prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        try:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+            # NamedTemporaryFile is 0600; keep the original file's mode (or the umask default)
+            try:
+                shutil.copymode(path, f.name)
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(f.name, 0o666 & ~umask)
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+    if hasattr(os, "O_DIRECTORY"):  # directories can't be opened for fsync on Windows
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 def load_jsonl(path):
-    rows = []
-    if os.path.exists(path):
-        with open(path) as f:
-            for line in f:
-                if line.strip():
-                    rows.append(json.loads(line))
-    return rows
+    if not os.path.exists(path):
+        return []
+    # One bulk binary read; orjson parses the raw bytes, so no per-line text decode
+    with open(path, "rb") as f:
+        data = f.read()
+    return [orjson.loads(line) for line in data.splitlines() if line.strip()]
+
+# Local-mode users keyed by lowercased email (first record wins). cache_resource hands
+# back the same dict without unpickling a copy per call, so callers must not mutate it.
+@st.cache_resource(ttl=60, show_spinner=False)
+def load_local_users():
+    users = {}
+    for r in load_jsonl("data/users.jsonl"):
+        users.setdefault(r["email"].lower(), r)
+    return users
 
 # ---- Data model ----
+Sex = Literal["m","f"]
+EnterpriseCategory = Literal["micro","small","medium","startup"]
+OwnershipForm = Literal["soleproprietorship","partnership","plc"]
+BusinessSector = Literal["manufacturing","construction","agriculture","mining","service","others"]
+BusinessPremise = Literal["rented","applicant_owned","government"]
+ModeOfFinance = Literal["conventional","ifb"]
+
+# Selectbox options, built once from the Literal types so the form and model can't drift
+SEX_OPTIONS = get_args(Sex)
+ENT_CAT_OPTIONS = get_args(EnterpriseCategory)
+OWNER_FORM_OPTIONS = get_args(OwnershipForm)
+SECTOR_OPTIONS = get_args(BusinessSector)
+PREMISE_OPTIONS = get_args(BusinessPremise)
+FIN_MODE_OPTIONS = get_args(ModeOfFinance)
+
 class Applicant(BaseModel):
     region: str
     batch: str
@@ -70,7 +181,7 @@ class Applicant(BaseModel):
     grandfather_name: str
     date_of_birth: date
     date_collected: date
-    sex: str = Field(pattern="^(m|f)$")
+    sex: Sex
     applicant_address: str
     has_business_license: bool
     trade_license_number: Optional[str] = None
@@ -78,13 +189,13 @@ class Applicant(BaseModel):
     registration_number: Optional[str] = None
     tin_number: Optional[str] = None
     date_of_business_license: Optional[date] = None
-    enterprise_category: str  # micro, small, medium, startup
-    ownership_form: str      # soleproprietorship, partnership, plc
-    business_sector: str     # manufacturing, construction, agriculture, mining, service, others
+    enterprise_category: EnterpriseCategory
+    ownership_form: OwnershipForm
+    business_sector: BusinessSector
     number_of_owners: int
     owners_names: str
     registered_address: str
-    business_premise: str    # rented, applicant_owned, government
+    business_premise: BusinessPremise
     male_employees: int
     female_employees: int
     business_capital_etb: float
@@ -103,37 +214,11 @@ class Applicant(BaseModel):
     cbe_account_number: str
     cbe_branch: str
     cbe_city: str
-    mode_of_finance: str     # conventional, ifb
-
-    @validator("enterprise_category")
-    def v1(cls, v):
-        if v not in ["micro","small","medium","startup"]:
-            raise ValueError("Invalid enterprise category")
-        return v
-
-    @validator("ownership_form")
-    def v2(cls, v):
-        if v not in ["soleproprietorship","partnership","plc"]:
-            raise ValueError("Invalid ownership form")
-        return v
-
-    @validator("business_sector")
-    def v3(cls, v):
-        if v not in ["manufacturing","construction","agriculture","mining","service","others"]:
-            raise ValueError("Invalid business sector")
-        return v
-
-    @validator("business_premise")
-    def v4(cls, v):
-        if v not in ["rented","applicant_owned","government"]:
-            raise ValueError("Invalid business premise")
-        return v
-
-    @validator("mode_of_finance")
-    def v5(cls, v):
-        if v not in ["conventional","ifb"]:
-            raise ValueError("Invalid mode of finance")
-        return v
+    mode_of_finance: ModeOfFinance
+
+APPLICANT_ADAPTER = TypeAdapter(Applicant)
+# Sheet1 column order for the Excel export
+SHEET1_COLUMNS = ("auto_number", "id", *Applicant.model_fields, "collected_by")
 
 # ---- UI ----
 st.set_page_config(page_title="EDI Loan Application", layout="wide")
@@ -161,17 +246,18 @@ def login_box():
     email = st.text_input("Email", key="login_email")
     password = st.text_input("Password", type="password", key="login_pwd")
     if st.button("Sign in"):
-        if supabase:
-            res = supabase.table("users").select("*").eq("email", email).execute()
+        if USE_SUPABASE:
+            res = get_supabase().table("users").select("*").eq("email", email).execute()
             rows = res.data or []
         else:
-            rows = [r for r in load_jsonl("data/users.jsonl") if r["email"].lower()==email.lower()]
+            user = load_local_users().get(email.lower())
+            rows = [user] if user else []
         if not rows:
             st.error("User not found")
         else:
             user = rows[0]
             if check_pwd(password, user["password_hash"]):
-                st.session_state.user = {"email": email, "id": user.get("id", str(uuid.uuid4()))}
+                st.session_state.user = {"email": email, "id": user.get("id") or uuid.uuid4().hex}
                 st.session_state.role = user.get("role","collector")
                 st.experimental_rerun()
             else:
@@ -192,11 +278,13 @@ def admin_create_user_box():
                 st.error("Passwords must match and be at least 6 chars")
             else:
                 rec = {"email": email.lower(), "password_hash": hash_pwd(pwd1), "role": role_sel}
-                if supabase_admin:
-                    supabase_admin.table("users").insert(rec).execute()
+                admin_client = get_supabase_admin()
+                if admin_client:
+                    admin_client.table("users").insert(rec).execute()
                 else:
-                    rec["id"] = str(uuid.uuid4())
+                    rec["id"] = uuid.uuid4().hex
                     save_jsonl("data/users.jsonl", rec)
+                    load_local_users.clear()
                 st.success("User created")
 
 if not st.session_state.user:
@@ -204,8 +292,15 @@ if not st.session_state.user:
     st.stop()
 
 st.success(f"Logged in as {st.session_state.user['email']} ({st.session_state.role})")
+if st.button("Sign out"):
+    _clear_pwd_cache()
+    st.session_state.user = None
+    st.session_state.role = "collector"
+    st.experimental_rerun()
 
 # ---- Collector page ----
+# Fragment: interactions inside the form rerun only this function, not the whole script
+@st.experimental_fragment
 def collector_page():
     st.subheader("New Applicant")
     with st.form("applicant_form", clear_on_submit=True):
@@ -224,7 +319,7 @@ def collector_page():
         c1,c2,c3 = st.columns(3)
         dob = c1.date_input("Date of Birth*", value=date(1990,1,1))
         collected = c2.date_input("Date of Data Collected*", value=date.today())
-        sex = c3.selectbox("Sex*", ["m","f"], help="m for male, f for female")
+        sex = c3.selectbox("Sex*", SEX_OPTIONS, help="m for male, f for female")
 
         address = st.text_input("Applicant Address (as per Kebele ID)*")
 
@@ -239,16 +334,16 @@ def collector_page():
         tin_no = c4.text_input("TIN Number")
 
         c1,c2,c3 = st.columns(3)
-        ent_cat = c1.selectbox("Category of Enterprise*", ["micro","small","medium","startup"])
-        owner_form = c2.selectbox("Form of Ownership*", ["soleproprietorship","partnership","plc"])
-        sector = c3.selectbox("Business Sector*", ["manufacturing","construction","agriculture","mining","service","others"])
+        ent_cat = c1.selectbox("Category of Enterprise*", ENT_CAT_OPTIONS)
+        owner_form = c2.selectbox("Form of Ownership*", OWNER_FORM_OPTIONS)
+        sector = c3.selectbox("Business Sector*", SECTOR_OPTIONS)
 
         c1,c2,c3 = st.columns(3)
         owners_n = c1.number_input("Number of Owners*", min_value=1, step=1, value=1)
         owners_names = c2.text_input("Name(s) of Owners*")
         reg_addr = c3.text_input("Registered Address*")
 
-        premise = st.selectbox("Business Premise*", ["rented","applicant_owned","government"])
+        premise = st.selectbox("Business Premise*", PREMISE_OPTIONS)
 
         c1,c2,c3 = st.columns(3)
         male_emp = c1.number_input("Male Employees*", min_value=0, step=1)
@@ -282,12 +377,12 @@ def collector_page():
         cbe_acc = c2.text_input("C.B.E Business Current Account Number*")
         cbe_branch = c3.text_input("Branch*")
         cbe_city = c4.text_input("City*")
-        mode_fin = c5.selectbox("Mode of Finance*", ["conventional","ifb"])
+        mode_fin = c5.selectbox("Mode of Finance*", FIN_MODE_OPTIONS)
 
         submitted = st.form_submit_button("Save Applicant")
         if submitted:
             try:
-                Applicant(
+                applicant = APPLICANT_ADAPTER.validate_python(dict(
                     region=region, batch=batch, zone=zone, woreda=woreda, kebele=kebele,
                     first_name=first_name, father_name=father_name, grandfather_name=grandfather_name,
                     date_of_birth=dob, date_collected=collected, sex=sex, applicant_address=address,
@@ -302,87 +397,100 @@ def collector_page():
                     guarantor_first_name=g_fn, guarantor_father_name=g_fan, guarantor_grandfather_name=g_gfn,
                     guarantor_phone=g_phone, guarantor_monthly_income=float(g_income),
                     credit_history=credit_hist, cbe_account_number=cbe_acc, cbe_branch=cbe_branch, cbe_city=cbe_city, mode_of_finance=mode_fin
-                )
+                ))
             except Exception as e:
                 st.error(f"Missing/invalid fields: {e}")
                 st.stop()
 
-            # Build record
-            rec = dict(
-                id=str(ULID()),
-                region=region, batch=batch, zone=zone, woreda=woreda, kebele=kebele,
-                first_name=first_name, father_name=father_name, grandfather_name=grandfather_name,
-                date_of_birth=str(dob), date_collected=str(collected), sex=sex, applicant_address=address,
-                has_business_license=has_license, trade_license_number=trade_license_no or None, trade=trade or None,
-                registration_number=reg_no or None, tin_number=tin_no or None, date_of_business_license=str(date_of_license) if (has_license and date_of_license) else None,
-                enterprise_category=ent_cat, ownership_form=owner_form, business_sector=sector,
-                number_of_owners=int(owners_n), owners_names=owners_names, registered_address=reg_addr,
-                business_premise=premise, male_employees=int(male_emp), female_employees=int(female_emp),
-                business_capital_etb=float(capital), monthly_revenue_etb=float(monthly_rev),
-                annual_revenue_last3=float(annual_rev3), net_profit_last3=float(net_profit),
-                financing_required_etb=float(finance_req), source_of_repayment=repay_src, purpose_of_funds=fund_purpose,
-                guarantor_first_name=g_fn, guarantor_father_name=g_fan, guarantor_grandfather_name=g_gfn,
-                guarantor_phone=g_phone, guarantor_monthly_income=float(g_income),
-                credit_history=credit_hist, cbe_account_number=cbe_acc, cbe_branch=cbe_branch, cbe_city=cbe_city, mode_of_finance=mode_fin,
-                collected_by=st.session_state.user["id"]
-            )
+            from ulid import ULID
+            # Build record from the validated model (mode="json" renders dates as ISO strings)
+            rec = {"id": ULID().hex, **applicant.model_dump(mode="json"), "collected_by": st.session_state.user["id"]}
             # Save to cloud/local
-            if supabase:
-                res = supabase.table("applicants").insert(rec).execute()
+            if USE_SUPABASE:
+                res = get_supabase().table("applicants").insert(rec).execute()
                 if res.data:
+                    fetch_applicants.clear()
                     st.success("Saved to cloud")
                 else:
                     st.error("Cloud save failed")
             else:
                 save_jsonl("data/applicants.jsonl", rec)
+                fetch_applicants.clear()
                 st.success("Saved locally (demo mode)")
 
+# Dashboard grid shows one page of a few columns; export still pulls full rows
+DASHBOARD_COLUMNS = ("auto_number","id","first_name","region","credit_history")
+PAGE_SIZE = 100
+# Low-cardinality columns of the projection above (region is the only one today)
+CATEGORICAL_COLUMNS = ("region",)
+
+# Cached so widget interactions on the dashboard don't refetch; cleared on writes
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_applicants(columns="*", page=None):
+    client = get_supabase_admin() or get_supabase()
+    if client:
+        q = client.table("applicants").select(columns if columns == "*" else ",".join(columns)).order("auto_number")
+        if page is not None:
+            q = q.range(page*PAGE_SIZE, (page+1)*PAGE_SIZE - 1)
+        return q.execute().data or []
+    rows = load_jsonl("data/applicants.jsonl")
+    if page is not None:
+        rows = rows[page*PAGE_SIZE:(page+1)*PAGE_SIZE]
+    if columns != "*":
+        # Skip keys local rows don't have (e.g. auto_number) instead of adding empty columns
+        rows = [{c: r[c] for c in columns if c in r} for r in rows]
+    return rows
+
 def admin_page():
+    # Heavy imports are deferred to the pages that use them; Python caches the module after the first call
+    import pandas as pd
     st.subheader("Admin Dashboard")
     if not is_admin(st.session_state.user["email"]):
         st.error("Admins only")
         return
 
-    # Load all applicants
-    if supabase_admin:
-        res = supabase_admin.table("applicants").select("*").order("auto_number").execute()
-        rows = res.data or []
-    elif supabase:
-        res = supabase.table("applicants").select("*").execute()
-        rows = res.data or []
-    else:
-        rows = load_jsonl("data/applicants.jsonl")
+    # Load one page of applicants
+    page = int(st.number_input("Page", min_value=0, step=1, value=0))
+    rows = fetch_applicants(DASHBOARD_COLUMNS, page)
 
     df = pd.DataFrame(rows)
+    # Low-cardinality columns go to the browser dictionary-encoded
+    for c in CATEGORICAL_COLUMNS:
+        if c in df:
+            df[c] = df[c].astype("category")
     st.dataframe(df)
 
     # Edit selected row (admin only)
-    if not df.empty:
+    if rows:
         st.markdown("### Edit Selected Applicant")
-        idx = st.number_input("Row index", min_value=0, max_value=len(df)-1, step=1, value=0)
-        row = df.iloc[int(idx)].to_dict()
+        idx = st.number_input("Row index", min_value=0, max_value=len(rows)-1, step=1, value=0)
+        # Same row as displayed; read the source dict rather than converting back from the frame
+        row = rows[int(idx)]
         # Simple example: update credit_history
         new_credit = st.text_input("Credit History", value=row.get("credit_history",""))
         if st.button("Update Credit History"):
-            if supabase_admin:
-                supabase_admin.table("applicants").update({"credit_history": new_credit}).eq("id", row["id"]).execute()
+            admin_client = get_supabase_admin()
+            if admin_client:
+                admin_client.table("applicants").update({"credit_history": new_credit}).eq("id", row["id"]).execute()
             else:
-                # local update
-                rows[int(idx)]["credit_history"] = new_credit
-                # rewrite file
-                with open("data/applicants.jsonl","w") as f:
-                    for r in rows:
-                        f.write(json.dumps(r)+"\n")
+                # local update: the page is projected, so rewrite from the full file
+                all_rows = load_jsonl("data/applicants.jsonl")
+                for r in all_rows:
+                    if r.get("id") == row["id"]:
+                        r["credit_history"] = new_credit
+                write_jsonl("data/applicants.jsonl", all_rows)
+            fetch_applicants.clear()
             st.success("Updated")
 
     # Export Excel (Sheets 1–3)
     if st.button("Download Excel (Sheets 1–3)"):
-        df = pd.DataFrame(rows)
+        from util.excel_template import export_excel_rows
+        rows = fetch_applicants()
         # Fill auto_number if not available (local mode fallback)
-        if "auto_number" not in df.columns:
-            df["auto_number"] = range(1, len(df)+1)
+        for i, r in enumerate(rows, start=1):
+            r.setdefault("auto_number", i)
         out_path = "EDI_export.xlsx"
-        export_excel(df, out_path)
+        export_excel_rows(rows, out_path, SHEET1_COLUMNS)
         with open(out_path, "rb") as f:
             st.download_button("Download file", data=f.read(), file_name="EDI_export.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
@@ -0,0 +1,64 @@
+# ---- Excel export (Sheet1 raw rows, Sheet2/Sheet3 summaries of Sheet1) ----
+# Written straight from the row dicts with xlsxwriter in constant_memory mode:
+# each row is flushed to disk as soon as the next one starts, so peak memory
+# does not grow with the number of applicants.
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
+
+SHEET2_KEYS = ("region", "zone", "woreda")
+SHEET3_KEYS = ("business_sector", "enterprise_category")
+SUM_FIELDS = ("male_employees", "female_employees", "business_capital_etb", "monthly_revenue_etb")
+
+def _num(v):
+    return v if isinstance(v, (int, float)) and not isinstance(v, bool) else 0
+
+def _key(v):
+    # Group the way Excel's EXACT compares: blank/None as "", everything else as text
+    return "" if v is None else str(v)
+
+def _write_summary(wb, name, keys, groups, col_of, n_rows, header):
+    # Summary cells are SUMPRODUCT(1*EXACT(...)*EXACT(...)) over Sheet1 (so edits there
+    # flow through). EXACT compares text exactly: no wildcards, blanks match blanks,
+    # "01" != "1"; non-numeric cells in the summed range count as 0.
+    # The totals computed here are stored as the cached formula results.
+    ws = wb.add_worksheet(name)
+    ws.write_row(0, 0, [*keys, "applicants", "male_employees", "female_employees",
+                        "total_employees", "business_capital_etb", "monthly_revenue_etb"], header)
+    rng = lambda c: f"Sheet1!${col_of[c]}$2:${col_of[c]}${n_rows+1}"
+    for i, (key, tot) in enumerate(sorted(groups.items()), start=1):
+        for j, k in enumerate(key):
+            ws.write_string(i, j, k)
+        match = "1*" + "*".join(f"EXACT({rng(k)},{xl_col_to_name(j)}{i+1})" for j, k in enumerate(keys))
+        n = len(keys)
+        ws.write_formula(i, n, f"=SUMPRODUCT({match})", None, tot["applicants"])
+        for j, f in enumerate(SUM_FIELDS[:2], start=n+1):
+            ws.write_formula(i, j, f"=SUMPRODUCT({match},{rng(f)})", None, tot[f])
+        male, female = xl_col_to_name(n+1), xl_col_to_name(n+2)
+        ws.write_formula(i, n+3, f"={male}{i+1}+{female}{i+1}", None,
+                         tot["male_employees"] + tot["female_employees"])
+        for j, f in enumerate(SUM_FIELDS[2:], start=n+4):
+            ws.write_formula(i, j, f"=SUMPRODUCT({match},{rng(f)})", None, tot[f])
+
+def export_excel_rows(rows, path, columns):
+    # Submitted values must stay plain text: strings_to_formulas off keeps "=1+1" from
+    # becoming a formula, strings_to_urls off keeps "http://..." / "mailto:..." from
+    # becoming clickable hyperlinks (and from counting against the per-sheet link limit)
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_formulas": False,
+                                    "strings_to_urls": False})
+    header = wb.add_format({"bold": True})
+    col_of = {c: xl_col_to_name(i) for i, c in enumerate(columns)}
+
+    ws = wb.add_worksheet("Sheet1")
+    ws.write_row(0, 0, columns, header)
+    sheet2, sheet3 = {}, {}
+    for i, r in enumerate(rows, start=1):
+        ws.write_row(i, 0, [r.get(c) for c in columns])
+        for groups, keys in ((sheet2, SHEET2_KEYS), (sheet3, SHEET3_KEYS)):
+            tot = groups.setdefault(tuple(_key(r.get(k)) for k in keys), dict.fromkeys(("applicants", *SUM_FIELDS), 0))
+            tot["applicants"] += 1
+            for f in SUM_FIELDS:
+                tot[f] += _num(r.get(f))
+
+    _write_summary(wb, "Sheet2", SHEET2_KEYS, sheet2, col_of, len(rows), header)
+    _write_summary(wb, "Sheet3", SHEET3_KEYS, sheet3, col_of, len(rows), header)
+    wb.close()